@@ -1,5 +1,8 @@
+import gc
+import logging
 import os
-import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 
 import streamlit as st
@@ -12,18 +15,50 @@ from transformers import (
 from peft import AutoPeftModelForCausalLM, PeftModel
 
 
+logger = logging.getLogger(__name__)
+
 ROOT_DIR = Path(__file__).parent
+MAX_NEW_TOKENS_LIMIT = 2048
+# Static KV cache room: a full-length reply plus this much conversation
+PROMPT_TOKEN_BUDGET = 6144
+STATIC_CACHE_MAX_LENGTH = MAX_NEW_TOKENS_LIMIT + PROMPT_TOKEN_BUDGET
 
 
-@st.cache_resource(show_spinner=True)
-def load_tokenizer_and_model(backend: str, cpu_base_model: str | None = None):
-    # Load local tokenizer (uses local tokenizer.json and chat_template.jinja)
-    tokenizer = AutoTokenizer.from_pretrained(
-        ROOT_DIR.as_posix(),
+class ContextTooLongError(RuntimeError):
+    pass
+
+
+@lru_cache(maxsize=4)
+def get_tokenizer(path_or_repo: str, local_files_only: bool = False):
+    # Tokenizer init parses tokenizer.json; keep it across Streamlit reruns
+    return AutoTokenizer.from_pretrained(
+        path_or_repo,
         trust_remote_code=True,
-        local_files_only=True,
+        local_files_only=local_files_only,
     )
 
+
+@st.cache_resource(show_spinner=False)
+def get_generation_worker():
+    # CUDA-graph state from mode="reduce-overhead" is thread-local, so the
+    # warm-up and every generate call run on this one long-lived thread
+    return ThreadPoolExecutor(max_workers=1)
+
+
+def submit_generation(model, fn, *args):
+    # Only the CUDA-graph path (the one holding the shared static cache) is
+    # pinned to the shared worker; other backends get a thread per call so
+    # one stalled session can't block the rest
+    if getattr(model, "_static_cache", None) is not None:
+        return get_generation_worker().submit(fn, *args)
+    executor = ThreadPoolExecutor(max_workers=1)
+    job = executor.submit(fn, *args)
+    executor.shutdown(wait=False)
+    return job
+
+
+@st.cache_resource(show_spinner=True)
+def load_tokenizer_and_model(backend: str, cpu_base_model: str | None = None):
     # Load PEFT adapter; auto-loads base model from adapter_config.json
     # Device handling
     has_cuda = torch.cuda.is_available()
@@ -42,24 +77,26 @@ def load_tokenizer_and_model(backend: str, cpu_base_model: str | None = None):
                 "torch_dtype": dtype,
                 "trust_remote_code": True,
                 "device_map": "auto",
+                "attn_implementation": "sdpa",
             }
             model = AutoPeftModelForCausalLM.from_pretrained(
                 ROOT_DIR.as_posix(),
                 **model_kwargs,
             )
-            tok = AutoTokenizer.from_pretrained(
-                ROOT_DIR.as_posix(), trust_remote_code=True, local_files_only=True
-            )
-            tokenizer = tok
+            model = merge_adapter(model)
+            model = quantize_int4_weight_only(model)
+            # Local tokenizer (uses local tokenizer.json and chat_template.jinja)
+            tokenizer = get_tokenizer(ROOT_DIR.as_posix(), local_files_only=True)
         elif backend == "Adapter + CPU base":
             if not cpu_base_model:
                 raise RuntimeError(
                     "CPU base model repo id is required for 'Adapter + CPU base' backend."
                 )
-            # CPU path: load full‑precision base and attach adapter
+            # CPU path: load base (bf16 where the CPU has native bf16 matmul,
+            # otherwise full precision) and attach adapter
             base = AutoModelForCausalLM.from_pretrained(
                 cpu_base_model,
-                torch_dtype=torch.float32,
+                torch_dtype=torch.bfloat16 if cpu_supports_bf16() else torch.float32,
                 device_map=None,
                 trust_remote_code=True,
                 low_cpu_mem_usage=True,
@@ -69,15 +106,15 @@ def load_tokenizer_and_model(backend: str, cpu_base_model: str | None = None):
                 ROOT_DIR.as_posix(),
                 trust_remote_code=True,
             )
-            tokenizer = AutoTokenizer.from_pretrained(
-                cpu_base_model, trust_remote_code=True
-            )
+            model = merge_adapter(model)
+            tokenizer = get_tokenizer(cpu_base_model)
         elif backend == "Open demo (distilgpt2)":
             # Fully open, small CPU model for demoing the UI
-            tokenizer = AutoTokenizer.from_pretrained("distilgpt2")
+            tokenizer = get_tokenizer("distilgpt2")
             model = AutoModelForCausalLM.from_pretrained(
                 "distilgpt2",
                 torch_dtype=torch.float32,
+                attn_implementation="sdpa",
             )
         elif backend == "Dummy echo":
             # No model required
@@ -91,9 +128,141 @@ def load_tokenizer_and_model(backend: str, cpu_base_model: str | None = None):
 
     if model is not None:
         model.eval()
+        # Resolve the input device once instead of walking parameters per turn
+        model._inference_device = next(model.parameters()).device
+        if has_cuda and backend == "Adapter (GPU)":
+            # Compile the decode step; warm up here so the first chat turn
+            # doesn't pay the one-time Dynamo/Inductor compile cost
+            if enable_static_cache(model, dtype):
+                # CUDA graphs replay against the fixed-size cache
+                if not compile_and_warm_up(tokenizer, model, mode="reduce-overhead", fullgraph=False):
+                    # Eager mode gains nothing from the fixed-size cache
+                    model._static_cache = None
+            else:
+                # Without the static cache, skip CUDA graphs and their
+                # thread affinity
+                compile_and_warm_up(tokenizer, model)
+        elif backend == "Adapter + CPU base":
+            # Prompt length changes every turn; dynamic shapes avoid recompiles
+            compile_and_warm_up(tokenizer, model, dynamic=True)
     return tokenizer, model
 
 
+def cpu_supports_bf16():
+    # AVX512-BF16 / AMX run bf16 GEMMs natively; elsewhere bf16 is emulated
+    # and slower than fp32
+    checks = ("_is_avx512_bf16_supported", "_is_amx_tile_supported")
+    return any(getattr(torch.cpu, name, lambda: False)() for name in checks)
+
+
+def merge_adapter(model):
+    # Adapters are fixed at inference; folding them into the base weights
+    # makes each projection a single GEMM. On a quantized base (the default
+    # bnb-4bit one) the merged delta would be rounded away by requantization,
+    # so the adapter stays live there.
+    if getattr(model.config, "quantization_config", None) is not None:
+        return model
+    return model.merge_and_unload()
+
+
+def quantize_int4_weight_only(model, group_size=128):
+    # Decoding reads every weight per token, so int4 weights cut the dominant
+    # memory traffic. torchao's int4 kernel needs bf16 weights on the GPU,
+    # and bases that are already quantized (e.g. bnb-4bit) are left alone.
+    if getattr(model.config, "quantization_config", None) is not None:
+        logger.info("Skipping int4 quantization: base model is already quantized")
+        return model
+    if model.dtype != torch.bfloat16:
+        logger.info("Skipping int4 quantization: needs bfloat16 weights, got %s", model.dtype)
+        return model
+    device_map = getattr(model, "hf_device_map", None) or {}
+    if any(str(d) in ("cpu", "disk") for d in device_map.values()):
+        logger.info("Skipping int4 quantization: some layers are offloaded from the GPU")
+        return model
+    try:
+        from torchao.quantization import quantize_
+    except ImportError:
+        logger.info("Skipping int4 quantization: optional torchao package is not installed")
+        return model
+    try:
+        from torchao.quantization import Int4WeightOnlyConfig
+        config = Int4WeightOnlyConfig(group_size=group_size)
+    except ImportError:
+        # Older torchao releases only export the functional form
+        from torchao.quantization import int4_weight_only
+        config = int4_weight_only(group_size=group_size)
+    quantize_(model, config)
+    return model
+
+
+def enable_static_cache(model, dtype):
+    # One preallocated KV cache of fixed length, reused every turn, keeps
+    # decode shapes fixed so the compiled forward can replay its CUDA graphs
+    # The cache is allocated on one device, so it can't serve layers that
+    # device_map="auto" spread over several GPUs (or offloaded)
+    devices = set(map(str, (getattr(model, "hf_device_map", None) or {}).values()))
+    if len(devices) > 1:
+        logger.info("Skipping static KV cache: model spans devices %s", sorted(devices))
+        return False
+    try:
+        from transformers import StaticCache
+    except ImportError:
+        return False
+    try:
+        cache = StaticCache(
+            config=model.config,
+            max_batch_size=1,
+            max_cache_len=STATIC_CACHE_MAX_LENGTH,
+            device=model._inference_device,
+            dtype=dtype,
+        )
+    except TypeError:
+        # Newer transformers size batch/device/dtype lazily on first use
+        cache = StaticCache(config=model.config, max_cache_len=STATIC_CACHE_MAX_LENGTH)
+    model._static_cache = cache
+    return True
+
+
+def static_cache_kwargs(model):
+    # Must run on the generation worker, right before generate()
+    cache = getattr(model, "_static_cache", None)
+    if cache is None:
+        return {}
+    cache.reset()
+    return {"past_key_values": cache}
+
+
+def compile_and_warm_up(tokenizer, model, **compile_kwargs):
+    # PEFT's generate() delegates to the wrapped transformers model, so an
+    # unmerged adapter model needs that model's forward compiled
+    target = model.get_base_model() if isinstance(model, PeftModel) else model
+    eager_forward = target.forward
+    target.forward = torch.compile(eager_forward, **compile_kwargs)
+    try:
+        # Compiles happen lazily; run a short generate so the first chat turn
+        # doesn't pay for them and so failures surface here, not mid-chat
+        submit_generation(model, warmup_model, tokenizer, model).result()
+    except Exception:
+        # Inductor needs a C compiler and Python headers at runtime; without
+        # them keep serving the model eagerly
+        logger.exception("torch.compile warm-up failed; falling back to eager mode")
+        target.forward = eager_forward
+        return False
+    return True
+
+
+def warmup_model(tokenizer, model, max_new_tokens=4):
+    device = model._inference_device
+    inputs = tokenizer(["Hello"], return_tensors="pt").to(device)
+    with torch.inference_mode():
+        model.generate(
+            **inputs,
+            **static_cache_kwargs(model),
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+        )
+
+
 def format_prompt(tokenizer, messages):
     # messages: list of {"role": "system"|"user"|"assistant", "content": str}
     # Use the model's chat template
@@ -115,6 +284,26 @@ def format_prompt(tokenizer, messages):
     return prompt
 
 
+def tokenize_prompt(tokenizer, prompt):
+    # Each turn's prompt extends the previous one (history + generation
+    # prompt), so only the new suffix needs tokenizing
+    cached = st.session_state.get("prefix_ids")
+    if cached is not None:
+        cached_name, cached_prompt, cached_ids = cached
+        if cached_name == tokenizer.name_or_path and prompt.startswith(cached_prompt):
+            delta = prompt[len(cached_prompt):]
+            delta_ids = tokenizer(
+                [delta], add_special_tokens=False, return_tensors="pt"
+            )["input_ids"]
+            input_ids = torch.cat([cached_ids, delta_ids], dim=-1)
+        else:
+            cached = None
+    if cached is None:
+        input_ids = tokenizer([prompt], return_tensors="pt")["input_ids"]
+    st.session_state["prefix_ids"] = (tokenizer.name_or_path, prompt, input_ids)
+    return input_ids
+
+
 def stream_generate(tokenizer, model, messages, max_new_tokens, temperature, top_p, repetition_penalty):
     # Dummy mode
     if model is None or tokenizer is None:
@@ -128,10 +317,30 @@ def stream_generate(tokenizer, model, messages, max_new_tokens, temperature, top
         return iterator(), None
 
     prompt = format_prompt(tokenizer, messages)
-    inputs = tokenizer([prompt], return_tensors="pt")
+    input_ids = tokenize_prompt(tokenizer, prompt)
+    inputs = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
 
-    device = next(model.parameters()).device
-    inputs = {k: v.to(device) for k, v in inputs.items()}
+    device = getattr(model, "_inference_device", torch.device("cpu"))
+    if device.type == "cuda":
+        # Pinned host memory lets the copy run async with launch prep
+        inputs = {k: v.pin_memory().to(device, non_blocking=True) for k, v in inputs.items()}
+    else:
+        inputs = {k: v.to(device) for k, v in inputs.items()}
+
+    if getattr(model, "_static_cache", None) is not None:
+        # The static cache holds prompt + reply; never ask for more than fits
+        room = STATIC_CACHE_MAX_LENGTH - input_ids.shape[-1]
+        if room <= 0:
+            raise ContextTooLongError(
+                f"This conversation has reached the {STATIC_CACHE_MAX_LENGTH}-token "
+                "limit of the GPU backend. Clear the chat to continue."
+            )
+        if room < max_new_tokens:
+            st.warning(
+                f"Conversation is close to the {STATIC_CACHE_MAX_LENGTH}-token limit; "
+                f"this reply is capped at {room} tokens."
+            )
+            max_new_tokens = room
 
     streamer = TextIteratorStreamer(
         tokenizer,
@@ -144,15 +353,28 @@ def stream_generate(tokenizer, model, messages, max_new_tokens, temperature, top
         attention_mask=inputs.get("attention_mask"),
         max_new_tokens=max_new_tokens,
         do_sample=(temperature > 0),
-        temperature=max(temperature, 1e-6),
-        top_p=top_p,
         repetition_penalty=repetition_penalty,
         streamer=streamer,
     )
-
-    thread = threading.Thread(target=model.generate, kwargs=generation_kwargs)
-    thread.start()
-    return streamer, thread
+    if temperature > 0:
+        # Sampling warpers only matter when sampling; greedy skips them
+        generation_kwargs.update(temperature=temperature, top_p=top_p)
+
+    def generate():
+        try:
+            generation_kwargs.update(static_cache_kwargs(model))
+            with torch.inference_mode():
+                model.generate(**generation_kwargs)
+        except BaseException:
+            # Unblock the UI loop reading the streamer; job.result() re-raises
+            streamer.end()
+            raise
+        finally:
+            # Drop the prompt tensors as soon as decoding ends
+            generation_kwargs.clear()
+
+    job = submit_generation(model, generate)
+    return streamer, job
 
 
 def init_session_state():
@@ -171,7 +393,7 @@ def main():
         temperature = st.slider("Temperature", 0.0, 2.0, 0.7, 0.1)
         top_p = st.slider("Top‑p", 0.1, 1.0, 0.95, 0.05)
         repetition_penalty = st.slider("Repetition Penalty", 1.0, 2.0, 1.1, 0.1)
-        max_new_tokens = st.slider("Max New Tokens", 16, 2048, 512, 16)
+        max_new_tokens = st.slider("Max New Tokens", 16, MAX_NEW_TOKENS_LIMIT, 512, 16)
 
         backend = st.selectbox(
             "Backend",
@@ -198,6 +420,13 @@ def main():
 
         if st.button("Clear Chat"):
             st.session_state.messages = []
+            st.session_state.pop("prefix_ids", None)
+            # Release this chat's prompt tensors and hand allocator slack back
+            # to the device. The model's static KV cache is fixed-size, shared
+            # by all sessions and reset before every turn, so it stays allocated.
+            gc.collect()
+            if has_cuda:
+                torch.cuda.empty_cache()
             st.rerun()
 
     tokenizer, model = load_tokenizer_and_model(backend, cpu_base_model)
@@ -221,22 +450,28 @@ def main():
             placeholder = st.empty()
             partial_text = ""
 
-            streamer, thread = stream_generate(
-                tokenizer,
-                model,
-                st.session_state.messages,
-                max_new_tokens=max_new_tokens,
-                temperature=temperature,
-                top_p=top_p,
-                repetition_penalty=repetition_penalty,
-            )
+            try:
+                streamer, job = stream_generate(
+                    tokenizer,
+                    model,
+                    st.session_state.messages,
+                    max_new_tokens=max_new_tokens,
+                    temperature=temperature,
+                    top_p=top_p,
+                    repetition_penalty=repetition_penalty,
+                )
+            except ContextTooLongError as e:
+                # Drop the unanswered turn so the history stays consistent
+                st.session_state.messages.pop()
+                st.error(str(e))
+                return
 
             for token_text in streamer:
                 partial_text += token_text
                 placeholder.markdown(partial_text)
 
-            if thread is not None:
-                thread.join()
+            if job is not None:
+                job.result()
 
         # Save assistant message
         st.session_state.messages.append({"role": "assistant", "content": partial_text})